@@ -0,0 +1,106 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# cython: cdivision=True
+"""
+Compiled alternative to the numba kernels in trilat.py, for environments
+where a JIT is undesirable. Build in place with
+
+    python setup.py build_ext --inplace
+
+and select it with ``python trilat.py --method cython``.
+"""
+from cython.parallel cimport prange
+from libc.math cimport sin, cos, asin, atan2, sqrt, M_PI, NAN
+
+# assuming elevation = 0
+cdef double earthR = 6371.0
+cdef double D2R = M_PI / 180.0
+cdef double R2D = 180.0 / M_PI
+# same tolerance as trilat._ZTOL
+cdef double ZTOL = 1e-6
+
+
+cdef inline void _trilat_one(const double* row, double* res) noexcept nogil:
+    """
+    Trilaterates one row laid out as for trilat.trilat_batch, writing long,
+    lat into res.
+    """
+    cdef double DistA = row[0] / 1000
+    cdef double DistB = row[1] / 1000
+    cdef double DistC = row[2] / 1000
+
+    # Convert geodetic Lat/Long to ECEF xyz
+    cdef double cosLat = cos(row[4] * D2R)
+    cdef double xA = earthR * cosLat * cos(row[3] * D2R)
+    cdef double yA = earthR * cosLat * sin(row[3] * D2R)
+    cdef double zA = earthR * sin(row[4] * D2R)
+    cosLat = cos(row[6] * D2R)
+    cdef double xB = earthR * cosLat * cos(row[5] * D2R)
+    cdef double yB = earthR * cosLat * sin(row[5] * D2R)
+    cdef double zB = earthR * sin(row[6] * D2R)
+    cosLat = cos(row[8] * D2R)
+    cdef double xC = earthR * cosLat * cos(row[7] * D2R)
+    cdef double yC = earthR * cosLat * sin(row[7] * D2R)
+    cdef double zC = earthR * sin(row[8] * D2R)
+
+    # D12 = P2 - P1, D13 = P3 - P1
+    cdef double d12x = xB - xA
+    cdef double d12y = yB - yA
+    cdef double d12z = zB - zA
+    cdef double d13x = xC - xA
+    cdef double d13y = yC - yA
+    cdef double d13z = zC - zA
+
+    cdef double d = sqrt(d12x*d12x + d12y*d12y + d12z*d12z)
+    cdef double exX = d12x / d
+    cdef double exY = d12y / d
+    cdef double exZ = d12z / d
+    cdef double i = exX*d13x + exY*d13y + exZ*d13z
+
+    cdef double tx = d13x - i*exX
+    cdef double ty = d13y - i*exY
+    cdef double tz = d13z - i*exZ
+    cdef double tnorm = sqrt(tx*tx + ty*ty + tz*tz)
+    cdef double eyX = tx / tnorm
+    cdef double eyY = ty / tnorm
+    cdef double eyZ = tz / tnorm
+    cdef double j = eyX*d13x + eyY*d13y + eyZ*d13z
+
+    # ez = ex cross ey
+    cdef double ezX = exY*eyZ - exZ*eyY
+    cdef double ezY = exZ*eyX - exX*eyZ
+    cdef double ezZ = exX*eyY - exY*eyX
+
+    cdef double DistA2 = DistA*DistA
+    cdef double x = (DistA2 - DistB*DistB + d*d) / (2*d)
+    cdef double y = ((DistA2 - DistC*DistC + i*i + j*j) / (2*j)) - ((i/j)*x)
+    # clamp rounding error below zero, but report inconsistent distances
+    # as nan
+    cdef double zz = DistA2 - x*x - y*y
+    cdef double z
+    if zz > 0:
+        z = sqrt(zz)
+    elif zz >= -ZTOL*DistA2:
+        z = 0.0
+    else:
+        z = NAN
+
+    cdef double triX = xA + x*exX + y*eyX + z*ezX
+    cdef double triY = yA + x*exY + y*eyY + z*ezY
+    cdef double triZ = zA + x*exZ + y*eyZ + z*ezZ
+
+    res[0] = atan2(triY, triX) * R2D
+    res[1] = asin(triZ / earthR) * R2D
+
+
+def trilat_batch(const double[:, ::1] inp, double[:, ::1] out):
+    """
+    Trilaterates every row of an (N, 9) C-contiguous float64 array laid out
+    as for trilat.trilat_batch, writing long, lat into the (N, 2) array
+    out. Rows are split across OpenMP threads with the GIL released.
+    """
+    cdef Py_ssize_t k
+    cdef Py_ssize_t n = inp.shape[0]
+    if out.shape[0] != n or out.shape[1] != 2 or inp.shape[1] != 9:
+        raise ValueError('expected an (N, 9) input and an (N, 2) output')
+    for k in prange(n, nogil=True, schedule='static'):
+        _trilat_one(&inp[k, 0], &out[k, 0])
@@ -0,0 +1,15 @@
+"""
+Builds the optional Cython kernel used by ``trilat.py --method cython``:
+
+    python setup.py build_ext --inplace
+"""
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+ext = Extension('_trilat_ext', ['_trilat_ext.pyx'],
+                # keep nan and inf semantics, which -ffast-math drops
+                extra_compile_args=['-O3', '-march=native', '-ffast-math',
+                                    '-fno-finite-math-only', '-fopenmp'],
+                extra_link_args=['-fopenmp'])
+
+setup(name='_trilat_ext', ext_modules=cythonize([ext]))
@@ -0,0 +1,100 @@
+"""
+Checks the trilateration methods in trilat.py against each other on the
+example file 'headless_mv_spatial.csv'. Run with pytest.
+"""
+import math
+import os
+
+import numpy
+import pytest
+from numpy.testing import assert_allclose
+
+import trilat
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'headless_mv_spatial.csv')
+
+# reference points A and B coincide, so the sample cannot be trilaterated
+DEGENERATE = ['x', '2.59', '5.27', '3.38', '-80.683356', '37.293064',
+              '-80.683356', '37.293064', '-80.683294', '37.293053']
+
+
+def _example():
+    names, arr = trilat.read_input(EXAMPLE)
+    with open(EXAMPLE, 'r') as f:
+        expected = numpy.array([trilat.trilat_row(line.strip().split(','))[1:]
+                                for line in f])
+    return arr, expected
+
+
+def _degenerate():
+    return numpy.array([DEGENERATE[1:]], dtype=numpy.float64)
+
+
+def test_trilat_batch_matches_trilat_row():
+    arr, expected = _example()
+    assert_allclose(trilat.trilat_batch(arr), expected, rtol=0, atol=1e-9)
+
+
+def test_degenerate_is_nan():
+    with numpy.errstate(all='ignore'):
+        assert numpy.isnan(trilat.trilat_row(DEGENERATE)[1:]).all()
+        assert numpy.isnan(trilat.trilat_batch(_degenerate())).all()
+
+
+def test_trilat_all_matches_trilat_row():
+    arr, expected = _example()
+    out = numpy.empty((arr.shape[0], 2))
+    trilat.trilat_all(arr, out)
+    assert_allclose(out, expected, rtol=0, atol=1e-9)
+
+
+def test_trilat_all_degenerate_is_nan():
+    out = numpy.empty((1, 2))
+    with numpy.errstate(all='ignore'):
+        trilat.trilat_all(_degenerate(), out)
+    assert numpy.isnan(out).all()
+
+
+def test_trilat_parallel_matches_trilat_row():
+    arr, expected = _example()
+    out = trilat.trilat_parallel(arr, processes=2, chunksize=64)
+    assert_allclose(out, expected, rtol=0, atol=1e-9)
+
+
+def test_single_precision_within_about_one_centimeter():
+    arr, expected = _example()
+    out = trilat.trilat_batch(arr, numpy.float32)
+    assert (numpy.isnan(out) == numpy.isnan(expected)).all()
+    # error in meters on a 6371 km sphere
+    lat = expected[:, 1] * trilat._D2R
+    east = (out[:, 0] - expected[:, 0]) * trilat._D2R * numpy.cos(lat)
+    north = (out[:, 1] - expected[:, 1]) * trilat._D2R
+    error = 6371000 * numpy.hypot(east, north)
+    assert numpy.nanmedian(error) < 0.01
+    assert numpy.nanmax(error) < 0.02
+
+
+def test_trilat_enu_batch_recovers_point():
+    arr, _ = _example()
+    anchors = arr[0, 3:]
+    lon, lat = -80.68332, 37.29305
+    point = trilat.lonlat_to_ecef(lon, lat)
+    # distances in meters from the point to A, B and C
+    dists = [1000 * math.dist(point, trilat.lonlat_to_ecef(anchors[k],
+                                                           anchors[k + 1]))
+             for k in (0, 2, 4)]
+    row = numpy.concatenate((dists, anchors))[None, :]
+    assert_allclose(trilat.trilat_enu_batch(row), [[lon, lat]],
+                    rtol=0, atol=1e-9)
+
+
+@pytest.mark.skipif(trilat._cython_core is None,
+                    reason='_trilat_ext is not built')
+def test_cython_matches_trilat_row():
+    arr, expected = _example()
+    rows = numpy.ascontiguousarray(numpy.vstack((arr, _degenerate())))
+    out = numpy.empty((rows.shape[0], 2))
+    trilat._cython_core.trilat_batch(rows, out)
+    assert_allclose(out[:-1], expected, rtol=0, atol=1e-9)
+    assert numpy.isnan(out[-1]).all()
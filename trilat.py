@@ -16,11 +16,99 @@ import math
 import numpy
 import argparse
 import csv
+import functools
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+try:
+    from numba import njit, prange
+    _have_numba = True
+except ImportError:
+    # numba is optional; without it the kernels below run as plain Python
+    _have_numba = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    # optional compiled kernel, built with setup.py from _trilat_ext.pyx
+    import _trilat_ext as _cython_core
+except ImportError:
+    _cython_core = None
 
 __author__ = "Brian J. Sanderson <brian@biologicallyrelevant.com"
+__all__ = ['trilat_row', 'trilat_batch', 'trilat_enu_batch', 'trilat_core',
+           'trilat_all', 'trilat_parallel', 'read_input', 'main']
+
+# degrees to radians and back
+_D2R = math.pi / 180.0
+_R2D = 180.0 / math.pi
+
+# Negative values of DistA^2 - x^2 - y^2 no larger than this fraction of
+# DistA^2 are taken as rounding error and clamped to zero; beyond it the
+# distances are inconsistent and the sample is reported as nan
+_ZTOL = 1e-6
+
+# numba fastmath flags, without the ones that assume no nan or inf
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
 
+# columns of the input file
+_COLUMNS = ['name', 'dist1', 'dist2', 'dist3',
+            'long1', 'lat1', 'long2', 'lat2', 'long3', 'lat3']
 
-def trilat(dist_line):
+
+def read_input(filename):
+    """
+    Reads the input file (see script docstring for expected format) and
+    returns an array of the sample names and an (N, 9) float array of the
+    remaining columns, parsed with pandas when it is available.
+    """
+    if pandas is not None:
+        df = pandas.read_csv(filename, header=None, names=_COLUMNS,
+                             dtype={'name': str}, keep_default_na=False,
+                             engine='c')
+        return (df['name'].to_numpy(dtype=str),
+                df[_COLUMNS[1:]].to_numpy(dtype=numpy.float64))
+    names = numpy.loadtxt(filename, delimiter=',', usecols=0, dtype=str,
+                          ndmin=1)
+    arr = numpy.loadtxt(filename, delimiter=',', usecols=range(1, 10),
+                        ndmin=2)
+    return names, arr
+
+
+def _norm3(v):
+    """
+    Euclidean length of a 3-vector, without the overhead of
+    numpy.linalg.norm.
+    """
+    return math.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+
+
+@functools.lru_cache(maxsize=1024)
+def lonlat_to_ecef(lon, lat, earthR=6371):
+    """
+    Converts a GPS coordinate in decimal degrees to ECEF x, y, z on the
+    authalic sphere. Cached, since the same reference points are usually
+    shared by many samples.
+    """
+    lat = lat * _D2R
+    lon = lon * _D2R
+    cosLat = math.cos(lat)
+    return (earthR * cosLat * math.cos(lon),
+            earthR * cosLat * math.sin(lon),
+            earthR * math.sin(lat))
+
+
+def trilat_row(dist_line):
     """
     Takes as an argument a line from the input file (see script docstring for
     expected format) and returns the trilaterated GPS coordinates of the
@@ -41,52 +129,39 @@ def trilat(dist_line):
     # using authalic sphere
     # if using an ellipsoid this step is slightly different
     # Convert geodetic Lat/Long to ECEF xyz
-    #   1. Convert Lat/Long to radians
-    #   2. Convert Lat/Long(radians) to ECEF
-
-    xA = earthR * (math.cos(math.radians(LatA))
-                   * math.cos(math.radians(LonA)))
-    yA = earthR * (math.cos(math.radians(LatA))
-                   * math.sin(math.radians(LonA)))
-    zA = earthR * (math.sin(math.radians(LatA)))
-
-    xB = earthR * (math.cos(math.radians(LatB))
-                   * math.cos(math.radians(LonB)))
-    yB = earthR * (math.cos(math.radians(LatB))
-                   * math.sin(math.radians(LonB)))
-    zB = earthR * (math.sin(math.radians(LatB)))
-
-    xC = earthR * (math.cos(math.radians(LatC))
-                   * math.cos(math.radians(LonC)))
-    yC = earthR * (math.cos(math.radians(LatC))
-                   * math.sin(math.radians(LonC)))
-    zC = earthR * (math.sin(math.radians(LatC)))
-
-    P1 = numpy.array([xA, yA, zA])
-    P2 = numpy.array([xB, yB, zB])
-    P3 = numpy.array([xC, yC, zC])
+    P1 = numpy.array(lonlat_to_ecef(LonA, LatA, earthR))
+    P2 = numpy.array(lonlat_to_ecef(LonB, LatB, earthR))
+    P3 = numpy.array(lonlat_to_ecef(LonC, LatC, earthR))
 
     # from wikipedia
     # transform to get circle 1 at origin
     # transform to get circle 2 on x axis
 
-    ex = (P2 - P1)/(numpy.linalg.norm(P2 - P1))
-    i = numpy.dot(ex, P3 - P1)
-    ey = (P3 - P1 - i*ex)/(numpy.linalg.norm(P3 - P1 - i*ex))
+    D12 = P2 - P1
+    D13 = P3 - P1
+    # a numpy float, so coincident reference points give nan, not an error
+    d = numpy.sqrt(D12 @ D12)
+    ex = D12/d
+    i = ex @ D13
+    tmp = D13 - i*ex
+    ey = tmp/_norm3(tmp)
     ez = numpy.cross(ex, ey)
-    d = numpy.linalg.norm(P2 - P1)
-    j = numpy.dot(ey, P3 - P1)
+    j = ey @ D13
 
     # from wikipedia
     # plug and chug using above values
-    x = (math.pow(DistA, 2) - math.pow(DistB, 2) + math.pow(d, 2))/(2*d)
-    y = ((math.pow(DistA, 2) - math.pow(DistC, 2)
-          + math.pow(i, 2) + math.pow(j, 2))/(2*j)) - ((i/j)*x)
+    DistA2 = DistA*DistA
+    x = (DistA2 - DistB*DistB + d*d)/(2*d)
+    y = ((DistA2 - DistC*DistC + i*i + j*j)/(2*j)) - ((i/j)*x)
 
-    # only one case shown here
-    try:
-        z = math.sqrt(math.pow(DistA, 2) - math.pow(x, 2) - math.pow(y, 2))
-    except:
+    # only one case shown here; clamp rounding error below zero, but
+    # report inconsistent distances as nan
+    zz = DistA2 - x*x - y*y
+    if zz > 0:
+        z = math.sqrt(zz)
+    elif zz >= -_ZTOL*DistA2:
+        z = 0.0
+    else:
         z = float('nan')
 
     # triPt is an array with ECEF x,y,z of trilateration point
@@ -94,14 +169,324 @@ def trilat(dist_line):
 
     # convert back to lat/long from ECEF
     # convert to degrees
-    lat = math.degrees(math.asin(triPt[2] / earthR))
-    lon = math.degrees(math.atan2(triPt[1], triPt[0]))
+    lat = math.asin(triPt[2] / earthR) * _R2D
+    lon = math.atan2(triPt[1], triPt[0]) * _R2D
 
     # write GPS coordinates for individual out to csv
     return [dist_line[0], lon, lat]
 
 
-if __name__ == '__main__':
+# original name of trilat_row
+trilat = trilat_row
+
+
+def trilat_batch(arr, dtype=numpy.float64, block=4096):
+    """
+    Vectorized form of trilat_row. Takes an (N, 9) float array of the
+    numeric columns of the input file (dist1, dist2, dist3, long1, lat1,
+    long2, lat2, long3, lat3) and returns an (N, 2) array of the
+    trilaterated long, lat of each sample.
+
+    Rows are processed block rows at a time so that the intermediate
+    arrays stay in cache for large inputs.
+
+    dtype sets the precision of the solve relative to the first reference
+    point. The GPS coordinates and ECEF positions are always kept in double
+    precision: on a 6371 km sphere single precision cannot resolve
+    reference points a few meters apart.
+    """
+    out = numpy.empty((arr.shape[0], 2))
+    for start in range(0, arr.shape[0], block):
+        stop = start + block
+        out[start:stop] = _trilat_block(arr[start:stop], dtype)
+    return out
+
+
+def _trilat_block(arr, dtype):
+    """
+    Trilaterates one block of rows for trilat_batch.
+    """
+    # assuming elevation = 0
+    earthR = 6371
+    DistA = (arr[:, 0] / 1000).astype(dtype, copy=False)
+    DistB = (arr[:, 1] / 1000).astype(dtype, copy=False)
+    DistC = (arr[:, 2] / 1000).astype(dtype, copy=False)
+
+    anchors = arr[:, 3:]
+    if len(anchors) and (anchors == anchors[0]).all():
+        # the same reference points for every sample; convert them once
+        # and let the (1, 3) results broadcast against the distances
+        anchors = anchors[:1]
+    LatA = numpy.deg2rad(anchors[:, 1])
+    LonA = numpy.deg2rad(anchors[:, 0])
+    LatB = numpy.deg2rad(anchors[:, 3])
+    LonB = numpy.deg2rad(anchors[:, 2])
+    LatC = numpy.deg2rad(anchors[:, 5])
+    LonC = numpy.deg2rad(anchors[:, 4])
+
+    # Convert geodetic Lat/Long to ECEF xyz, one column at a time
+    cosLatA = numpy.cos(LatA)
+    cosLatB = numpy.cos(LatB)
+    cosLatC = numpy.cos(LatC)
+    P1 = earthR * numpy.column_stack((cosLatA * numpy.cos(LonA),
+                                      cosLatA * numpy.sin(LonA),
+                                      numpy.sin(LatA)))
+    P2 = earthR * numpy.column_stack((cosLatB * numpy.cos(LonB),
+                                      cosLatB * numpy.sin(LonB),
+                                      numpy.sin(LatB)))
+    P3 = earthR * numpy.column_stack((cosLatC * numpy.cos(LonC),
+                                      cosLatC * numpy.sin(LonC),
+                                      numpy.sin(LatC)))
+
+    # row-wise equivalents of the norm/dot calls in trilat_row
+    D12 = (P2 - P1).astype(dtype, copy=False)
+    D13 = (P3 - P1).astype(dtype, copy=False)
+    d = numpy.sqrt(numpy.einsum('ij,ij->i', D12, D12))
+    ex = D12 / d[:, None]
+    i = numpy.einsum('ij,ij->i', ex, D13)
+    tmp = D13 - i[:, None] * ex
+    ey = tmp / numpy.sqrt(numpy.einsum('ij,ij->i', tmp, tmp))[:, None]
+    ez = numpy.cross(ex, ey)
+    j = numpy.einsum('ij,ij->i', ey, D13)
+
+    DistA2 = DistA*DistA
+    x = (DistA2 - DistB*DistB + d*d) / (2*d)
+    y = ((DistA2 - DistC*DistC + i*i + j*j) / (2*j)) - ((i/j)*x)
+    # clamp rounding error below zero, but report inconsistent distances
+    # as nan
+    zz = DistA2 - x*x - y*y
+    z = numpy.where(zz >= -_ZTOL*DistA2, numpy.sqrt(numpy.maximum(zz, 0)),
+                    numpy.nan)
+
+    triPt = P1 + (x[:, None]*ex + y[:, None]*ey + z[:, None]*ez)
+
+    lat = numpy.rad2deg(numpy.arcsin(triPt[:, 2] / earthR))
+    lon = numpy.rad2deg(numpy.arctan2(triPt[:, 1], triPt[:, 0]))
+
+    return numpy.column_stack((lon, lat))
+
+
+def trilat_enu_batch(arr):
+    """
+    Planar approximation of trilat_batch for reference points a few km
+    apart, taking and returning arrays laid out the same way. Positions are
+    projected onto the plane tangent to the sphere at the first reference
+    point (east, north in meters), where the three circle equations reduce
+    to a 2x2 linear system solved directly by Cramer's rule.
+    """
+    earthR = 6371000.0
+    DistA = arr[:, 0]
+    DistB = arr[:, 1]
+    DistC = arr[:, 2]
+    LonA = arr[:, 3] * _D2R
+    LatA = arr[:, 4] * _D2R
+
+    # east, north offsets of B and C from A
+    cosLatA = numpy.cos(LatA)
+    eB = earthR * cosLatA * (arr[:, 5] * _D2R - LonA)
+    nB = earthR * (arr[:, 6] * _D2R - LatA)
+    eC = earthR * cosLatA * (arr[:, 7] * _D2R - LonA)
+    nC = earthR * (arr[:, 8] * _D2R - LatA)
+
+    # subtracting circle A from circles B and C leaves
+    #   2*eB*e + 2*nB*n = |B|^2 + DistA^2 - DistB^2
+    #   2*eC*e + 2*nC*n = |C|^2 + DistA^2 - DistC^2
+    bB = eB*eB + nB*nB + DistA*DistA - DistB*DistB
+    bC = eC*eC + nC*nC + DistA*DistA - DistC*DistC
+    det = 2 * (eB*nC - nB*eC)
+    e = (bB*nC - nB*bC) / det
+    n = (eB*bC - bB*eC) / det
+
+    lon = (LonA + e / (earthR * cosLatA)) * _R2D
+    lat = (LatA + n / earthR) * _R2D
+    return numpy.column_stack((lon, lat))
+
+
+# views of the shared input and output arrays, set up once per worker
+_shared = {}
+
+
+def _init_worker(in_name, out_name, n):
+    """
+    Pool initializer: attaches each worker to the shared memory blocks
+    created by trilat_parallel.
+    """
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    _shared['shm'] = (shm_in, shm_out)
+    _shared['in'] = numpy.ndarray((n, 9), numpy.float64, buffer=shm_in.buf)
+    _shared['out'] = numpy.ndarray((n, 2), numpy.float64, buffer=shm_out.buf)
+
+
+def _trilat_range(bounds):
+    """
+    Trilaterates rows lo to hi of the shared input into the shared output.
+    """
+    lo, hi = bounds
+    _shared['out'][lo:hi] = trilat_batch(_shared['in'][lo:hi])
+
+
+def trilat_parallel(arr, processes=None, chunksize=1024):
+    """
+    Runs trilat_batch over an (N, 9) array in a pool of worker processes.
+    The input and output live in shared memory, so only the row ranges
+    are sent to the workers.
+    """
+    n = arr.shape[0]
+    # SharedMemory refuses a size of zero
+    shm_in = shared_memory.SharedMemory(create=True, size=max(n * 9 * 8, 1))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(n * 2 * 8, 1))
+    try:
+        numpy.ndarray((n, 9), numpy.float64, buffer=shm_in.buf)[:] = arr
+        ranges = [(lo, min(lo + chunksize, n))
+                  for lo in range(0, n, chunksize)]
+        # spawn rather than fork: forking after numba's threading layer
+        # has started leaves the calling process unable to exit
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=processes or os.cpu_count(),
+                      initializer=_init_worker,
+                      initargs=(shm_in.name, shm_out.name, n)) as pool:
+            pool.map(_trilat_range, ranges)
+        return numpy.ndarray((n, 2), numpy.float64, buffer=shm_out.buf).copy()
+    finally:
+        for shm in (shm_in, shm_out):
+            shm.close()
+            shm.unlink()
+
+
+@njit(fastmath=_FASTMATH, cache=True, inline='always')
+def _ecef_core(lon, lat):
+    """
+    Scalar ECEF conversion used by the numba kernels. Takes a GPS
+    coordinate in decimal degrees and returns an (x, y, z) tuple.
+    """
+    earthR = 6371.0
+    lat = lat * _D2R
+    lon = lon * _D2R
+    cosLat = math.cos(lat)
+    return (earthR * cosLat * math.cos(lon),
+            earthR * cosLat * math.sin(lon),
+            earthR * math.sin(lat))
+
+
+@njit(fastmath=_FASTMATH, cache=True, inline='always')
+def _solve_core(DistA, DistB, DistC, xA, yA, zA, xB, yB, zB, xC, yC, zC):
+    """
+    Scalar trilateration from the distances in meters and the ECEF
+    coordinates of the three reference points. Returns a (lon, lat) tuple.
+    All vector operations are written out by component so that no arrays
+    are allocated.
+    """
+    earthR = 6371.0
+    DistA = DistA / 1000
+    DistB = DistB / 1000
+    DistC = DistC / 1000
+
+    # D12 = P2 - P1, D13 = P3 - P1
+    d12x = xB - xA
+    d12y = yB - yA
+    d12z = zB - zA
+    d13x = xC - xA
+    d13y = yC - yA
+    d13z = zC - zA
+
+    d = math.sqrt(d12x*d12x + d12y*d12y + d12z*d12z)
+    exX = d12x / d
+    exY = d12y / d
+    exZ = d12z / d
+    i = exX*d13x + exY*d13y + exZ*d13z
+
+    tx = d13x - i*exX
+    ty = d13y - i*exY
+    tz = d13z - i*exZ
+    tnorm = math.sqrt(tx*tx + ty*ty + tz*tz)
+    eyX = tx / tnorm
+    eyY = ty / tnorm
+    eyZ = tz / tnorm
+    j = eyX*d13x + eyY*d13y + eyZ*d13z
+
+    # ez = ex cross ey
+    ezX = exY*eyZ - exZ*eyY
+    ezY = exZ*eyX - exX*eyZ
+    ezZ = exX*eyY - exY*eyX
+
+    x = (DistA*DistA - DistB*DistB + d*d) / (2*d)
+    y = ((DistA*DistA - DistC*DistC + i*i + j*j) / (2*j)) - ((i/j)*x)
+    # clamp rounding error below zero, but report inconsistent distances
+    # as nan
+    zz = DistA*DistA - x*x - y*y
+    if zz > 0:
+        z = math.sqrt(zz)
+    elif zz >= -_ZTOL*DistA*DistA:
+        z = 0.0
+    else:
+        z = math.nan
+
+    triX = xA + x*exX + y*eyX + z*ezX
+    triY = yA + x*exY + y*eyY + z*ezY
+    triZ = zA + x*exZ + y*eyZ + z*ezZ
+
+    lat = math.asin(triZ / earthR) * _R2D
+    lon = math.atan2(triY, triX) * _R2D
+    return lon, lat
+
+
+@njit(fastmath=_FASTMATH, cache=True, inline='always')
+def trilat_core(DistA, DistB, DistC, LonA, LatA, LonB, LatB, LonC, LatC):
+    """
+    Scalar form of trilat_row for compilation with numba. Takes the distances
+    in meters and the GPS coordinates in decimal degrees and returns a
+    (lon, lat) tuple.
+    """
+    xA, yA, zA = _ecef_core(LonA, LatA)
+    xB, yB, zB = _ecef_core(LonB, LatB)
+    xC, yC, zC = _ecef_core(LonC, LatC)
+    return _solve_core(DistA, DistB, DistC,
+                       xA, yA, zA, xB, yB, zB, xC, yC, zC)
+
+
+@njit(cache=True)
+def _same_anchors(arr):
+    """
+    True if every row of arr shares the reference points of the first row.
+    """
+    for k in range(1, arr.shape[0]):
+        for c in range(3, 9):
+            if arr[k, c] != arr[0, c]:
+                return False
+    return arr.shape[0] > 0
+
+
+@njit(parallel=True, fastmath=_FASTMATH, cache=True)
+def trilat_all(arr, out):
+    """
+    Runs trilat_core over every row of an (N, 9) array laid out as for
+    trilat_batch, writing long, lat into the (N, 2) array out. The scalar
+    kernels are inlined into the loop body, so each row is converted and
+    solved in registers without any intermediate arrays.
+    """
+    if _same_anchors(arr):
+        # convert the shared reference points once, outside the loop
+        xA, yA, zA = _ecef_core(arr[0, 3], arr[0, 4])
+        xB, yB, zB = _ecef_core(arr[0, 5], arr[0, 6])
+        xC, yC, zC = _ecef_core(arr[0, 7], arr[0, 8])
+        for k in prange(arr.shape[0]):
+            out[k, 0], out[k, 1] = _solve_core(arr[k, 0], arr[k, 1],
+                                               arr[k, 2], xA, yA, zA,
+                                               xB, yB, zB, xC, yC, zC)
+    else:
+        for k in prange(arr.shape[0]):
+            out[k, 0], out[k, 1] = trilat_core(arr[k, 0], arr[k, 1],
+                                               arr[k, 2], arr[k, 3],
+                                               arr[k, 4], arr[k, 5],
+                                               arr[k, 6], arr[k, 7],
+                                               arr[k, 8])
+
+
+def main():
+    """
+    Command-line entry point; see the script docstring.
+    """
     # Parser for command-line args
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -110,14 +495,50 @@ if __name__ == '__main__':
                                required=True)
     requiredNamed.add_argument('-o', '--output', help='Output TSV file',
                                required=True)
+    parser.add_argument('--single', action='store_true',
+                        help='Solve in single precision (numpy method only)')
+    parser.add_argument('-m', '--method',
+                        choices=['numpy', 'numba', 'multiprocessing', 'enu',
+                                 'cython'],
+                        default='numpy',
+                        help='Implementation used to trilaterate the samples '
+                             '(default: %(default)s)')
     args = parser.parse_args()
+    if args.single and args.method != 'numpy':
+        parser.error('--single is only supported by the numpy method')
+    if args.method == 'numba' and not _have_numba:
+        parser.error('the numba method needs numba to be installed')
+    if args.method == 'cython' and _cython_core is None:
+        parser.error('the cython method needs _trilat_ext built with '
+                     '"python setup.py build_ext --inplace"')
+
+    names, arr = read_input(args.input)
+    if args.method == 'numba':
+        coords = numpy.empty((arr.shape[0], 2))
+        trilat_all(arr, coords)
+    elif args.method == 'multiprocessing':
+        coords = trilat_parallel(arr)
+    elif args.method == 'enu':
+        coords = trilat_enu_batch(arr)
+    elif args.method == 'cython':
+        coords = numpy.empty((arr.shape[0], 2))
+        _cython_core.trilat_batch(numpy.ascontiguousarray(arr), coords)
+    else:
+        coords = trilat_batch(arr, numpy.float32 if args.single
+                              else numpy.float64)
 
-    # Output csv file
-    with open(args.output, 'w', newline='\n') as csvfile:
+    # Output csv file, written in blocks through a 1 MiB buffer
+    block = 10000
+    with open(args.output, 'w', newline='\n', buffering=1 << 20) as csvfile:
         writer = csv.writer(csvfile, delimiter='\t',
                             quotechar='|', quoting=csv.QUOTE_MINIMAL)
         writer.writerow(['name', 'long', 'lat'])
-        with open(args.input, 'r') as f:
-            for line in f:
-                out_line = trilat(line.strip().split(','))
-                writer.writerow(out_line)
+        for start in range(0, len(names), block):
+            stop = start + block
+            writer.writerows(zip(names[start:stop].tolist(),
+                                 coords[start:stop, 0].tolist(),
+                                 coords[start:stop, 1].tolist()))
+
+
+if __name__ == '__main__':
+    main()